@@ -1,16 +1,22 @@
+import json
+import os
 import shutil
+import socket
 import traceback
 from argparse import ArgumentParser
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
 
 from m_dl.ytdlpitem import YTDLPItem
 
 from .config import config, load_config
-from .db import Database
-from .download import download_and_get_path
+from .db import Database, DatabaseItem
+from .download import download_and_get_path, move_to_library
 from .log import log, setup_logging
-from .tagger import tag_file
+from .loudness import Loudness, analyze_file
+from .profiling import profiler
+from .tagger import Tags, tag_file
 from .ytapi import PlaylistItem, VideoInaccessibleError, YTApi
 
 
@@ -21,6 +27,9 @@ def new_liked_videos(db: Database):
         client_id=config.get("client_id", None),
         client_secret=config.get("client_secret", None),
         refresh_token=config.get("refresh_token", None),
+        token_cache_path=config.get(
+            "token_cache", Path("~").expanduser() / "m-dl" / "token.json"
+        ),
     )
 
     playlist_id = config.get("playlist_id", "LL")
@@ -58,6 +67,171 @@ def backup_database():
     shutil.copy2(db_path, backup_path)
 
 
+def replaygain_pool():
+    """Return a process pool for loudness analysis, or None if it is disabled"""
+
+    if not config.get("replaygain", False):
+        return None
+
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        raise RuntimeError(
+            "ReplayGain analysis requires numpy, please install m-dl with the 'replaygain' extra"
+        )
+
+    return ProcessPoolExecutor(config.get("replaygain_workers", None))
+
+
+class Ingest:
+    """Downloads and tags claimed items.
+
+    Loudness analysis and moving files from the staging folder into the library run in the background, while the
+    next item downloads. Items are only marked as processed once their file is in the library.
+    """
+
+    def __init__(self, db: Database, worker_id: str) -> None:
+        self.db = db
+        self.worker_id = worker_id
+
+        self.library_path = Path(config["path"])
+        staging_path = config.get("staging_path", None)
+        self.staging_path = Path(staging_path) if staging_path is not None else None
+
+        self.analysis_pool = replaygain_pool()
+        # a single thread, so that only one file is written to the library at a time
+        self.move_pool = (
+            ThreadPoolExecutor(1, thread_name_prefix="m-dl-move")
+            if self.staging_path is not None
+            else None
+        )
+
+        self.analyzing: list[tuple[DatabaseItem, Path, Future[Loudness]]] = []
+        self.moving: list[tuple[DatabaseItem, Path, Future[Path]]] = []
+
+    def _is_staged(self, path: Path):
+        return self.staging_path is not None and path.parent == self.staging_path
+
+    def _discard(self, path: Path):
+        """Delete a file left in the staging folder by a failed item"""
+
+        if self._is_staged(path):
+            path.unlink(missing_ok=True)
+
+    def process(self, item: DatabaseItem):
+        with profiler.stage("download", item.url):
+            if self.staging_path is not None:
+                self.staging_path.mkdir(parents=True, exist_ok=True)
+                output_path = download_and_get_path(item.url, self.staging_path)
+            else:
+                output_path = download_and_get_path(item.url, self.library_path)
+
+        # a duplicate of a file in the library, handle it the same way as downloading into the library: keep and tag
+        # the existing file
+        library_file = self.library_path / output_path.name
+        if self._is_staged(output_path) and library_file.exists():
+            log.warning(
+                "Output path %s already exists, discarding staged file", library_file
+            )
+            output_path.unlink()
+            output_path = library_file
+
+        try:
+            if self.analysis_pool is None:
+                self._tag(item, output_path, None)
+            else:
+                future = self.analysis_pool.submit(analyze_file, output_path)
+                self.analyzing.append((item, output_path, future))
+        except BaseException:
+            self._discard(output_path)
+            raise
+
+    def _tag(self, item: DatabaseItem, output_path: Path, loudness: Loudness | None):
+        tags: Tags = {
+            "title": item.title,
+            "artist": item.artist,
+            "url": item.url,
+            "added_at": item.added_at,
+        }
+        if loudness is not None:
+            tags["rg_track_gain"] = loudness.track_gain
+            tags["rg_track_peak"] = loudness.track_peak
+
+        with profiler.stage("tag", item.url):
+            tag_file(output_path, tags)
+
+        if loudness is not None:
+            self.db.set_replaygain(item.url, loudness.track_gain, loudness.track_peak)
+
+        if self.move_pool is None or not self._is_staged(output_path):
+            self.db.mark_processed(item.url, True)
+        else:
+            future = self.move_pool.submit(
+                move_to_library, output_path, self.library_path
+            )
+            self.moving.append((item, output_path, future))
+
+    def _failed(self, item: DatabaseItem, output_path: Path, e: BaseException):
+        log.error("Item failed to process", exc_info=e)
+        self._discard(output_path)
+        self.db.release_item(item.url, self.worker_id)
+
+    def poll(self, *, wait: bool = False):
+        """Finish items whose background work is done. If `wait` is true, wait for all items to finish."""
+
+        analyzing = self.analyzing
+        self.analyzing = []
+
+        for item, output_path, future in analyzing:
+            if not wait and not future.done():
+                self.analyzing.append((item, output_path, future))
+                continue
+
+            try:
+                loudness = future.result()
+            except BaseException as e:
+                # interrupted while waiting, rather than an error from the worker
+                if not future.done():
+                    raise
+                # the download itself succeeded, so tag the file anyway
+                log.warning("Loudness analysis failed: %s", item, exc_info=e)
+                loudness = None
+
+            try:
+                self._tag(item, output_path, loudness)
+            except Exception as e:
+                self._failed(item, output_path, e)
+
+        moving = self.moving
+        self.moving = []
+
+        for item, staged_path, future in moving:
+            if not wait and not future.done():
+                self.moving.append((item, staged_path, future))
+                continue
+
+            try:
+                output_path = future.result()
+            except BaseException as e:
+                # interrupted while waiting, rather than an error from the worker
+                if not future.done():
+                    raise
+                self._failed(item, staged_path, e)
+                continue
+
+            log.debug("Moved to library: %s", output_path)
+            self.db.mark_processed(item.url, True)
+
+    def close(self):
+        try:
+            self.poll(wait=True)
+        finally:
+            if self.analysis_pool is not None:
+                self.analysis_pool.shutdown(cancel_futures=True)
+            if self.move_pool is not None:
+                self.move_pool.shutdown(cancel_futures=True)
+
+
 def tag_tempo():
     import subprocess
 
@@ -71,6 +245,30 @@ def tag_tempo():
     subprocess.run(cmd)
 
 
+def search_database(query: str, limit: int, as_json: bool):
+    db_path = Path(config["path"]) / config["filenames"]["database"]
+
+    with Database(db_path) as db:
+        results = list(db.search(query, limit))
+
+    if as_json:
+        output = [
+            {
+                "title": r.title,
+                "artist": r.artist,
+                "url": r.url,
+                "added_at": r.added_at.isoformat() if r.added_at else None,
+                "processed": r.processed,
+            }
+            for r in results
+        ]
+        print(json.dumps(output, ensure_ascii=False, indent=2))
+    else:
+        for r in results:
+            print(f"{r.artist} - {r.title}")
+            print(f"    {r.url}")
+
+
 def parse_args():
     parser = ArgumentParser("m-dl")
 
@@ -78,6 +276,11 @@ def parse_args():
     parser.add_argument("--skip-youtube", action="store_true")
     parser.add_argument("--config", type=Path)
     parser.add_argument("--allow-duplicate", action="store_true")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="profile each step of the run, and write the results to the database backup folder",
+    )
     parser.add_argument(
         "--tag",
         nargs=4,
@@ -85,7 +288,105 @@ def parse_args():
         metavar=("PATH", "TITLE", "ARTIST", "URL"),
     )
 
-    return parser.parse_args()
+    subparsers = parser.add_subparsers(dest="command")
+
+    search_parser = subparsers.add_parser(
+        "search", help="search the database by title, artist or url"
+    )
+    search_parser.add_argument("query")
+    search_parser.add_argument("-n", "--limit", type=int, default=20)
+    search_parser.add_argument("--json", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.command == "search" and len(args.query.split()) == 0:
+        parser.error("search query must not be empty")
+
+    return args
+
+
+def run(args):
+    backup_database()
+
+    db_path = Path(config["path"]) / config["filenames"]["database"]
+
+    with Database(db_path) as db:
+        for url in args.urls:
+            log.info("Processing manual URL: %s", url)
+            with profiler.stage("resolve", url):
+                item = YTDLPItem.from_url(url)
+            if args.allow_duplicate:
+                db.add_url(
+                    item.url,
+                    title=item.title,
+                    artist=item.artist,
+                    added_at=item.added_at,
+                    processed=False,
+                )
+                log.info("New video from manual: %s", item.title)
+            elif db.add_new_url(
+                item.url,
+                title=item.title,
+                artist=item.artist,
+                added_at=item.added_at,
+                processed=False,
+            ):
+                log.info("New video from manual: %s", item.title)
+            else:
+                log.info("Database already contains this URL, skipping it: %s", url)
+
+        if not args.skip_youtube:
+            with profiler.stage("sync"):
+                new_videos = new_liked_videos(db)
+
+            for vid in new_videos:
+                # another process may have added it since it was fetched
+                added = db.add_new_url(
+                    vid.url,
+                    title=vid.title,
+                    artist=vid.artist,
+                    added_at=vid.added_at,
+                    processed=False,
+                )
+                if added:
+                    log.info("New video from playlist: %s", vid.title)
+
+        # identifies this process when claiming items, so several processes can share the database
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        lease_seconds = config.get("lease_seconds", 3600)
+
+        ingest = Ingest(db, worker_id)
+
+        try:
+            for item in db.claim_items(worker_id, lease_seconds=lease_seconds):
+                log.info("Processing: %s", item)
+                try:
+                    ingest.process(item)
+                except KeyboardInterrupt as e:
+                    log.info("Received KeyboardInterrupt, exiting...")
+                    db.release_item(item.url, worker_id)
+                    break
+                except Exception as e:
+                    log.error("Item failed to process", exc_info=e)
+                    db.release_item(item.url, worker_id)
+
+                ingest.poll()
+
+            ingest.close()
+        finally:
+            # items still leased here weren't finished, let the next run retry them straight away
+            released = db.release_all(worker_id)
+            if released > 0:
+                log.warning("Released %d unfinished items", released)
+
+        skipped = db.count_leased(exclude_owner=worker_id)
+        if skipped > 0:
+            log.info("Skipped %d items leased by other processes", skipped)
+
+    # tag BPM info for foobar2000
+    log.info("tagging BPM info for untagged files")
+    with profiler.stage("tempo"):
+        tag_tempo()
 
 
 def main():
@@ -122,57 +423,19 @@ def main():
         )
         return
 
-    backup_database()
-
-    db_path = Path(config["path"]) / config["filenames"]["database"]
-
-    with Database(db_path) as db:
-        for url in args.urls:
-            log.info("Processing manual URL: %s", url)
-            item = YTDLPItem.from_url(url)
-            if not args.allow_duplicate and db.has_url(item.url):
-                log.info("Database already contains this URL, skipping it: %s", url)
-            else:
-                log.info("New video from manual: %s", item.title)
-                db.add_url(
-                    item.url,
-                    title=item.title,
-                    artist=item.artist,
-                    added_at=item.added_at,
-                    processed=False,
-                )
-
-        if not args.skip_youtube:
-            for vid in new_liked_videos(db):
-                log.info("New video from playlist: %s", vid.title)
-                db.add_url(
-                    vid.url,
-                    title=vid.title,
-                    artist=vid.artist,
-                    added_at=vid.added_at,
-                    processed=False,
-                )
-
-        for item in db.unprocessed_items():
-            log.info("Processing: %s", item)
-            try:
-                output_path = download_and_get_path(item.url, config["path"])
-                tag_file(
-                    output_path,
-                    {
-                        "title": item.title,
-                        "artist": item.artist,
-                        "url": item.url,
-                        "added_at": item.added_at,
-                    },
-                )
-                db.mark_processed(item.url, True)
-            except KeyboardInterrupt as e:
-                log.info("Received KeyboardInterrupt, exiting...")
-                break
-            except Exception as e:
-                log.error("Item failed to process", exc_info=e)
+    if args.command == "search":
+        search_database(args.query, args.limit, args.json)
+        return
 
-    # tag BPM info for foobar2000
-    log.info("tagging BPM info for untagged files")
-    tag_tempo()
+    if args.profile:
+        profiler.enable()
+
+    try:
+        run(args)
+    finally:
+        # write the profile even if the run failed, since those are the runs worth looking at
+        if args.profile:
+            profile_dir = (
+                Path(config["path"]) / config["filenames"]["database_backup_dir"]
+            )
+            profiler.write(profile_dir)
@@ -1,3 +1,5 @@
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime
 from sqlite3 import Connection
@@ -11,6 +13,30 @@ class DatabaseItem:
     added_at: datetime
 
 
+@dataclass
+class SearchResult:
+    title: str
+    url: str
+    artist: str
+    # only known for items in the new table
+    added_at: datetime | None
+    processed: bool | None
+
+
+def _fts_query(query: str):
+    """Convert a user query into an FTS5 query where every word is a prefix match"""
+
+    terms = []
+    for word in query.split():
+        word = word.replace('"', '""')
+        terms.append(f'"{word}"*')
+
+    if len(terms) == 0:
+        raise ValueError("Search query must not be empty")
+
+    return " ".join(terms)
+
+
 class Database:
     def __init__(self, path) -> None:
         self.con = Connection(path, isolation_level=None)
@@ -21,7 +47,25 @@ class Database:
     def setup_connection(con: Connection):
         con.execute("PRAGMA foreign_keys = 1")
 
+    @contextmanager
+    def _immediate(self):
+        """Run statements in a transaction that takes the write lock up front"""
+
+        self.con.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.con.execute("ROLLBACK")
+            raise
+        self.con.execute("COMMIT")
+
     def migrate(self):
+        # several processes may start at once, so the schema must be checked and changed in one transaction
+        with self._immediate():
+            self._migrate_tables()
+            self._migrate_search()
+
+    def _migrate_tables(self):
         execute = self.con.execute
 
         execute("CREATE INDEX IF NOT EXISTS index_music_title ON music(title)")
@@ -44,6 +88,97 @@ class Database:
         execute("CREATE INDEX IF NOT EXISTS index_music_v2_artist ON music_v2(artist)")
         execute("CREATE INDEX IF NOT EXISTS index_music_v2_url ON music_v2(url)")
 
+        # leases let multiple processes work through the unprocessed items without doing the same item twice
+        columns = {row[1] for row in execute("PRAGMA table_info(music_v2)")}
+        if "lease_owner" not in columns:
+            execute("ALTER TABLE music_v2 ADD COLUMN lease_owner TEXT")
+        if "lease_expires_at" not in columns:
+            # unix timestamp in seconds
+            execute("ALTER TABLE music_v2 ADD COLUMN lease_expires_at INTEGER")
+
+        # loudness measured when the item was processed
+        if "rg_track_gain" not in columns:
+            execute("ALTER TABLE music_v2 ADD COLUMN rg_track_gain REAL")
+        if "rg_track_peak" not in columns:
+            execute("ALTER TABLE music_v2 ADD COLUMN rg_track_peak REAL")
+
+        execute(
+            "CREATE INDEX IF NOT EXISTS index_music_v2_queue ON music_v2(processed, added_at)"
+        )
+
+    def _migrate_search(self):
+        """Create the full-text search index over both tables, and keep it in sync using triggers.
+
+        The rowid of the index is the rowid of the source row, negated for rows in the legacy table.
+        """
+
+        execute = self.con.execute
+
+        search_exists = (
+            execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'music_search'"
+            ).fetchone()
+            is not None
+        )
+
+        if not search_exists:
+            execute(
+                """
+                CREATE VIRTUAL TABLE music_search USING fts5 (
+                    title,
+                    artist,
+                    url,
+                    prefix = '2 3',
+                    tokenize = 'unicode61 remove_diacritics 2'
+                )
+                """
+            )
+            execute(
+                """
+                INSERT INTO music_search (rowid, title, artist, url)
+                SELECT -rowid, title, artist, url FROM music
+                """
+            )
+            execute(
+                """
+                INSERT INTO music_search (rowid, title, artist, url)
+                SELECT rowid, title, artist, url FROM music_v2
+                """
+            )
+
+        for table, sign in (("music", "-"), ("music_v2", "")):
+            execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_search_insert
+                AFTER INSERT ON {table}
+                BEGIN
+                    INSERT INTO music_search (rowid, title, artist, url)
+                    VALUES ({sign}new.rowid, new.title, new.artist, new.url);
+                END
+                """
+            )
+            execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_search_delete
+                AFTER DELETE ON {table}
+                BEGIN
+                    DELETE FROM music_search WHERE rowid = {sign}old.rowid;
+                END
+                """
+            )
+            # only fire on columns in the index, so that marking items as processed stays cheap
+            execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_search_update
+                AFTER UPDATE OF title, artist, url ON {table}
+                BEGIN
+                    DELETE FROM music_search WHERE rowid = {sign}old.rowid;
+                    INSERT INTO music_search (rowid, title, artist, url)
+                    VALUES ({sign}new.rowid, new.title, new.artist, new.url);
+                END
+                """
+            )
+
     def __enter__(self):
         return self
 
@@ -105,22 +240,168 @@ class Database:
         params = (title, artist, url, added_at, 1 if processed else 0)
         self.con.execute(sql, params)
 
+    def add_new_url(
+        self,
+        url: str,
+        *,
+        title: str | None = None,
+        artist: str | None = None,
+        added_at: datetime | None = None,
+        processed: bool = False,
+    ):
+        """Add a URL unless either table already contains it. Return whether it was added.
+
+        The check and insert happen in one transaction, so concurrent processes can't both add the same URL.
+        """
+
+        with self._immediate():
+            if self.has_url(url):
+                return False
+
+            self.add_url(
+                url,
+                title=title,
+                artist=artist,
+                added_at=added_at,
+                processed=processed,
+            )
+            return True
+
     def mark_processed(self, url: str, processed: bool):
         sql = """
             UPDATE music_v2
-            SET processed = ?
+            SET processed = ?, lease_owner = NULL, lease_expires_at = NULL
             WHERE url = ?
         """
         params = (1 if processed else 0, url)
         self.con.execute(sql, params)
 
-    def unprocessed_items(self):
+    def set_replaygain(self, url: str, track_gain: float, track_peak: float):
+        sql = """
+            UPDATE music_v2
+            SET rg_track_gain = ?, rg_track_peak = ?
+            WHERE url = ?
+        """
+        params = (track_gain, track_peak, url)
+        self.con.execute(sql, params)
+
+    def unprocessed_items(self, page_size: int = 100):
+        """Iterate through all unprocessed items, fetching them from the database one page at a time"""
+
         sql = """
-            SELECT title, url, artist, added_at
+            SELECT rowid, title, url, artist, added_at
+            FROM music_v2
+            WHERE processed = 0 AND (added_at, rowid) > (?, ?)
+            ORDER BY added_at, rowid
+            LIMIT ?
+        """
+        last_added_at, last_rowid = "", 0
+
+        while True:
+            rows = self.con.execute(
+                sql, (last_added_at, last_rowid, page_size)
+            ).fetchall()
+
+            for rowid, title, url, artist, added_at in rows:
+                last_added_at, last_rowid = added_at, rowid
+                yield DatabaseItem(title, url, artist, datetime.fromisoformat(added_at))
+
+            if len(rows) < page_size:
+                break
+
+    def _claim_next(self, owner: str, lease_seconds: int, after: tuple[str, int]):
+        """Lease the next unprocessed item after the given (added_at, rowid) position"""
+
+        sql = """
+            UPDATE music_v2
+            SET lease_owner = ?, lease_expires_at = ?
+            WHERE rowid = (
+                SELECT rowid
+                FROM music_v2
+                WHERE processed = 0
+                  AND (lease_expires_at IS NULL OR lease_expires_at <= ?)
+                  AND (added_at, rowid) > (?, ?)
+                ORDER BY added_at, rowid
+                LIMIT 1
+            )
+            RETURNING rowid, title, url, artist, added_at
+        """
+        now = int(time.time())
+        params = (owner, now + lease_seconds, now, *after)
+
+        # take the write lock up front, so that no other process can claim the same row in between
+        with self._immediate():
+            rows = self.con.execute(sql, params).fetchall()
+
+        return rows[0] if len(rows) > 0 else None
+
+    def claim_items(self, owner: str, *, lease_seconds: int = 3600):
+        """Iterate through unprocessed items, leasing each one to the given owner before yielding it.
+
+        Items leased by other owners are skipped until their lease expires. Each claimed item should be
+        finished with `mark_processed` or handed back with `release_item`. Released items are not yielded
+        again by the same iterator.
+        """
+
+        after = ("", 0)
+
+        while True:
+            row = self._claim_next(owner, lease_seconds, after)
+            if row is None:
+                break
+
+            rowid, title, url, artist, added_at = row
+            after = (added_at, rowid)
+            yield DatabaseItem(title, url, artist, datetime.fromisoformat(added_at))
+
+    def release_all(self, owner: str):
+        """Give up every lease held by the given owner, and return how many were released"""
+
+        sql = """
+            UPDATE music_v2
+            SET lease_owner = NULL, lease_expires_at = NULL
+            WHERE lease_owner = ? AND processed = 0
+        """
+        return self.con.execute(sql, (owner,)).rowcount
+
+    def count_leased(self, *, exclude_owner: str | None = None):
+        """Return how many unprocessed items are leased, optionally ignoring leases of the given owner"""
+
+        sql = """
+            SELECT COUNT(*)
             FROM music_v2
             WHERE processed = 0
-            ORDER BY added_at
+              AND lease_expires_at > ?
+              AND lease_owner IS NOT ?
+        """
+        params = (int(time.time()), exclude_owner)
+        return self.con.execute(sql, params).fetchone()[0]
+
+    def release_item(self, url: str, owner: str):
+        """Give up the lease on an item, so that other processes can pick it up"""
+
+        sql = """
+            UPDATE music_v2
+            SET lease_owner = NULL, lease_expires_at = NULL
+            WHERE url = ? AND lease_owner = ?
+        """
+        self.con.execute(sql, (url, owner))
+
+    def search(self, query: str, limit: int = 20):
+        """Search both tables by title, artist and url, with the best matches first"""
+
+        sql = """
+            SELECT s.title, s.url, s.artist, m.added_at, m.processed
+            FROM music_search AS s
+            LEFT JOIN music_v2 AS m ON s.rowid > 0 AND m.rowid = s.rowid
+            WHERE music_search MATCH ?
+            ORDER BY bm25(music_search, 10.0, 5.0, 1.0)
+            LIMIT ?
         """
-        for title, url, artist, added_at in self.con.cursor().execute(sql).fetchall():
-            added_at = datetime.fromisoformat(added_at)
-            yield DatabaseItem(title, url, artist, added_at)
+        params = (_fts_query(query), limit)
+        for title, url, artist, added_at, processed in self.con.execute(sql, params):
+            if added_at is not None:
+                added_at = datetime.fromisoformat(added_at)
+            if processed is not None:
+                processed = processed != 0
+            yield SearchResult(title, url, artist, added_at, processed)
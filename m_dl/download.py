@@ -1,5 +1,6 @@
 import os
 import re
+import shutil
 import tempfile
 import time
 from pathlib import Path
@@ -9,6 +10,7 @@ from yt_dlp import YoutubeDL
 
 from .config import config
 from .log import log
+from .ratelimit import ThrottledError, rate_limited
 
 
 class Auth(TypedDict):
@@ -30,7 +32,7 @@ def auth_patterns() -> dict[str, Auth]:
     return patterns
 
 
-class NicoVideoBusyException(Exception):
+class NicoVideoBusyException(ThrottledError):
     def __init__(self) -> None:
         super().__init__("NicoVideo is currently busy, please try again later")
 
@@ -75,7 +77,7 @@ def download(url: str, folder_path):
 
     # check nicovideo quality before proceeding
     # don't add password yet since it needs to do mfa
-    check_nico_quality(url, options)
+    rate_limited(url, lambda: check_nico_quality(url, options))
 
     # add password if needed
     for pattern, auth in auth_patterns().items():
@@ -92,8 +94,11 @@ def download(url: str, folder_path):
 
         break
 
-    with YoutubeDL(options) as ydl:
-        ydl.download(url)
+    def run():
+        with YoutubeDL(options) as ydl:
+            ydl.download(url)
+
+    rate_limited(url, run)
 
 
 def download_and_get_path(url: str, folder_path):
@@ -152,3 +157,61 @@ def download_and_get_path(url: str, folder_path):
             temp_path.rename(output_path)
 
     return output_path
+
+
+def _fsync_dir(path):
+    # Windows can't open directories, and doesn't need this for renames to be durable
+    if os.name == "nt":
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _same_device(a, b):
+    return os.stat(a).st_dev == os.stat(b).st_dev
+
+
+def move_to_library(path: Path, folder_path) -> Path:
+    """Move a finished file from the staging folder into the library folder.
+
+    If the folders are on different devices, the file is copied to a temporary name, flushed to disk, then renamed,
+    so the library never contains a partially written file.
+    """
+
+    output_path = Path(folder_path) / path.name
+
+    # if output path already exists, then this is a duplicate
+    if output_path.exists():
+        log.warning(
+            "Output path %s already exists, discarding staged file", output_path
+        )
+        path.unlink()
+        return output_path
+
+    if _same_device(path, folder_path):
+        path.rename(output_path)
+        return output_path
+
+    log.debug("Copying %s to library", path.name)
+
+    partial_path = output_path.with_name(output_path.name + ".part")
+    try:
+        with open(path, "rb") as src, open(partial_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        os.replace(partial_path, output_path)
+    except BaseException:
+        # don't leave a partial file in the library
+        partial_path.unlink(missing_ok=True)
+        raise
+    _fsync_dir(folder_path)
+
+    path.unlink()
+
+    return output_path
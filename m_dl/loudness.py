@@ -0,0 +1,224 @@
+import json
+import subprocess
+import tempfile
+from dataclasses import dataclass
+
+# BS.1770 specifies the K-weighting filter for 48 kHz, so audio is always resampled to that
+SAMPLE_RATE = 48000
+
+# loudness is measured from 100 ms sub-blocks, which also is enough overlap for the filter's impulse response
+SUB_BLOCK = SAMPLE_RATE // 10
+OVERLAP = SUB_BLOCK
+FRAME_SIZE = 1 << 18
+
+# ReplayGain 2.0 reference level, in LUFS
+REFERENCE_LOUDNESS = -18.0
+
+# K-weighting filter as two biquads (b0, b1, b2, a1, a2), from ITU-R BS.1770-4
+K_WEIGHTING = [
+    # high shelf
+    (
+        1.53512485958697,
+        -2.69169618940638,
+        1.19839281085285,
+        -1.69065929318241,
+        0.73248077421585,
+    ),
+    # high pass
+    (1.0, -2.0, 1.0, -1.99004745483398, 0.99007225036621),
+]
+
+
+@dataclass
+class Loudness:
+    # integrated loudness in LUFS
+    integrated: float
+    # ReplayGain track gain in dB
+    track_gain: float
+    # ReplayGain track peak, as a linear sample peak
+    track_peak: float
+
+
+def _channels(path):
+    probe = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "a:0",
+            "-show_entries",
+            "stream=channels",
+            "-of",
+            "json",
+            str(path),
+        ],
+        capture_output=True,
+        check=True,
+    )
+    channels = json.loads(probe.stdout)["streams"][0]["channels"]
+
+    # anything beyond stereo is downmixed, since only L/R have a weight of 1
+    return min(channels, 2)
+
+
+def _decode(path, chunk_size: int):
+    """Decode a file using FFmpeg, yielding float32 arrays of shape (channels, chunk_size)"""
+
+    import numpy as np
+
+    channels = _channels(path)
+
+    # a corrupt stream can log an error per packet, which would fill a pipe and block FFmpeg while we wait on
+    # stdout, so errors go to a file instead
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(
+            [
+                "ffmpeg",
+                "-v",
+                "error",
+                "-i",
+                str(path),
+                "-map",
+                "a:0",
+                "-ac",
+                str(channels),
+                "-ar",
+                str(SAMPLE_RATE),
+                "-f",
+                "f32le",
+                "-",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=stderr_file,
+        )
+        assert process.stdout is not None
+
+        frame_bytes = channels * 4
+
+        try:
+            while True:
+                data = process.stdout.read(chunk_size * frame_bytes)
+                if len(data) == 0:
+                    break
+
+                data = data[: len(data) - len(data) % frame_bytes]
+                yield np.frombuffer(data, dtype="<f4").reshape(-1, channels).T
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+
+        if returncode != 0:
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+            raise subprocess.CalledProcessError(returncode, "ffmpeg", stderr=stderr)
+
+
+def _k_weighting_response(size: int):
+    """Frequency response of the K-weighting filter, for an FFT of the given size"""
+
+    import numpy as np
+
+    z = np.exp(-1j * np.linspace(0, np.pi, size // 2 + 1))
+    response = np.ones_like(z)
+    for b0, b1, b2, a1, a2 in K_WEIGHTING:
+        response *= (b0 + b1 * z + b2 * z**2) / (1 + a1 * z + a2 * z**2)
+
+    return response.astype(np.complex64)
+
+
+def _measure(chunks):
+    """K-weight the audio and return the mean square of each 100 ms sub-block summed over channels, and the
+    sample peak.
+
+    NumPy has no vectorized IIR filter, so the filter is applied in the frequency domain using overlap-save, one
+    frame at a time. The filter's impulse response has decayed to nothing after 100 ms, which is used as the overlap.
+    """
+
+    import numpy as np
+
+    response = _k_weighting_response(FRAME_SIZE)
+
+    # previous input samples, used as the overlap of the next frame
+    history = None
+    # filtered samples that don't fill a whole sub-block yet
+    leftover = None
+
+    powers = []
+    peak = 0.0
+
+    for chunk in chunks:
+        if history is None or leftover is None:
+            history = np.zeros((chunk.shape[0], OVERLAP), dtype=np.float32)
+            leftover = np.zeros((chunk.shape[0], 0), dtype=np.float32)
+
+        if chunk.size > 0:
+            peak = max(peak, float(np.abs(chunk).max()))
+
+        for start in range(0, chunk.shape[1], FRAME_SIZE - OVERLAP):
+            frame = np.concatenate(
+                [history, chunk[:, start : start + FRAME_SIZE - OVERLAP]], axis=1
+            )
+            history = frame[:, -OVERLAP:]
+
+            spectrum = np.fft.rfft(frame, n=FRAME_SIZE) * response
+            # the start of each frame is corrupted by the frame's end wrapping around
+            filtered = np.fft.irfft(spectrum, n=FRAME_SIZE)[:, OVERLAP : frame.shape[1]]
+
+            filtered = np.concatenate([leftover, filtered.astype(np.float32)], axis=1)
+            count = filtered.shape[1] // SUB_BLOCK
+            energy = np.square(filtered[:, : count * SUB_BLOCK])
+            energy = energy.reshape(energy.shape[0], count, SUB_BLOCK)
+            powers.append(energy.sum(axis=(0, 2), dtype=np.float64) / SUB_BLOCK)
+            leftover = filtered[:, count * SUB_BLOCK :]
+
+    if len(powers) == 0:
+        return np.zeros(0), peak
+
+    return np.concatenate(powers), peak
+
+
+def _gated_loudness(sub_block_powers):
+    """Gated integrated loudness as specified in BS.1770, in LUFS"""
+
+    import numpy as np
+
+    # 400 ms blocks with 75% overlap, each made of 4 sub-blocks
+    if len(sub_block_powers) < 4:
+        return float("-inf")
+
+    p = sub_block_powers
+    power = (p[:-3] + p[1:-2] + p[2:-1] + p[3:]) / 4
+
+    with np.errstate(divide="ignore"):
+        loudness = -0.691 + 10 * np.log10(power)
+
+    # absolute gate
+    power = power[loudness > -70]
+    if len(power) == 0:
+        return float("-inf")
+
+    # relative gate
+    relative_gate = -0.691 + 10 * np.log10(power.mean()) - 10
+    power = power[-0.691 + 10 * np.log10(power) > relative_gate]
+
+    return float(-0.691 + 10 * np.log10(power.mean()))
+
+
+def _loudness(chunks) -> Loudness:
+    import numpy as np
+
+    sub_block_powers, peak = _measure(chunks)
+    integrated = _gated_loudness(sub_block_powers)
+
+    # silent tracks are left as-is
+    track_gain = REFERENCE_LOUDNESS - integrated if np.isfinite(integrated) else 0.0
+
+    return Loudness(integrated, round(track_gain, 2), round(peak, 6))
+
+
+def analyze_file(path) -> Loudness:
+    """Measure the loudness of a file and compute its ReplayGain values"""
+
+    # whole frames of new samples, so the file is read one frame at a time
+    return _loudness(_decode(path, FRAME_SIZE - OVERLAP))
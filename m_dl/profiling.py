@@ -0,0 +1,175 @@
+import cProfile
+import io
+import pstats
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from .log import log
+
+# branches of the call tree smaller than this are left out of the collapsed stacks, in seconds
+MIN_STACK_TIME = 0.0001
+MAX_STACK_DEPTH = 200
+
+
+@dataclass
+class StageProfile:
+    stage: str
+    url: str | None
+    # wall clock time in seconds
+    duration: float
+    profile: cProfile.Profile
+
+
+def _frame_name(func: tuple[str, int, str]):
+    filename, lineno, name = func
+
+    # built-in functions have no file
+    if filename == "~" and lineno == 0:
+        return name
+
+    path = Path(filename)
+    if path.parent.name != "":
+        return f"{name} ({path.parent.name}/{path.name}:{lineno})"
+    return f"{name} ({path.name}:{lineno})"
+
+
+def _collapsed_stacks(stats: pstats.Stats, prefix: list[str]):
+    """Convert cProfile's caller/callee graph into collapsed stacks, as used by flamegraph tools.
+
+    cProfile only records direct callers, so time is split between callers by how much time each caller spent
+    in the function. Recursive calls are cut off.
+    """
+
+    raw: dict = stats.stats  # type: ignore
+
+    # callee time by caller
+    children: dict[tuple, dict[tuple, float]] = {}
+    for func, (_, _, _, _, callers) in raw.items():
+        for caller, (_, _, _, caller_ct) in callers.items():
+            children.setdefault(caller, {})[func] = caller_ct
+
+    roots = [func for func, (_, _, _, _, callers) in raw.items() if len(callers) == 0]
+
+    lines: dict[str, float] = {}
+
+    def walk(func, budget: float, stack: list[str], seen: set):
+        _, _, tt, ct, _ = raw[func]
+        if ct <= 0 or budget < MIN_STACK_TIME or len(stack) > MAX_STACK_DEPTH:
+            return
+
+        stack = stack + [_frame_name(func)]
+        scale = budget / ct
+
+        key = ";".join(stack)
+        lines[key] = lines.get(key, 0.0) + tt * scale
+
+        for child, child_ct in children.get(func, {}).items():
+            if child in seen:
+                continue
+            walk(child, child_ct * scale, stack, seen | {child})
+
+    for root in roots:
+        walk(root, raw[root][3], prefix, {root})
+
+    return lines
+
+
+class Profiler:
+    """Profiles each stage of a run separately, so they can be attributed to m-dl's steps and items"""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.profiles: list[StageProfile] = []
+        # cProfile can't be nested, so inner stages count towards the outer stage
+        self._active = False
+
+    def enable(self):
+        self.enabled = True
+
+    @contextmanager
+    def stage(self, stage: str, url: str | None = None):
+        if not self.enabled or self._active:
+            yield
+            return
+
+        self._active = True
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            duration = time.perf_counter() - start
+            self.profiles.append(StageProfile(stage, url, duration, profile))
+            self._active = False
+
+    def _collapsed(self):
+        lines: dict[str, float] = {}
+
+        for p in self.profiles:
+            # flamegraph tools split frames on semicolons
+            prefix = [p.stage] if p.url is None else [p.stage, p.url.replace(";", "_")]
+
+            stats = pstats.Stats(p.profile)
+            for key, seconds in _collapsed_stacks(stats, prefix).items():
+                lines[key] = lines.get(key, 0.0) + seconds
+
+        # flamegraph tools expect integer sample counts, use microseconds
+        return "".join(
+            f"{key} {round(seconds * 1_000_000)}\n"
+            for key, seconds in lines.items()
+            if round(seconds * 1_000_000) > 0
+        )
+
+    def _summary(self, top: int):
+        out = io.StringIO()
+
+        stages: dict[str, list[StageProfile]] = {}
+        for p in self.profiles:
+            stages.setdefault(p.stage, []).append(p)
+
+        out.write("Time per stage:\n")
+        for stage, profiles in stages.items():
+            total = sum(p.duration for p in profiles)
+            out.write(f"  {stage:<10} {total:10.3f}s  ({len(profiles)} calls)\n")
+
+        out.write("\nSlowest items:\n")
+        items = sorted(
+            (p for p in self.profiles if p.url is not None),
+            key=lambda p: p.duration,
+            reverse=True,
+        )
+        for p in items[:top]:
+            out.write(f"  {p.stage:<10} {p.duration:10.3f}s  {p.url}\n")
+
+        for stage, profiles in stages.items():
+            out.write(f"\n===== {stage} =====\n")
+            stats = pstats.Stats(profiles[0].profile, stream=out)
+            for p in profiles[1:]:
+                stats.add(p.profile)
+            stats.sort_stats("cumulative").print_stats(top)
+
+        return out.getvalue()
+
+    def write(self, folder: Path, top: int = 30):
+        """Write a collapsed stack file and a summary of the slowest functions to the given folder"""
+
+        name = time.strftime("profile_%Y-%m-%d %H_%M_%S")
+        collapsed_path = folder / f"{name}.collapsed"
+        summary_path = folder / f"{name}.txt"
+
+        folder.mkdir(parents=True, exist_ok=True)
+
+        log.info("Writing profile to: %s", collapsed_path)
+        with open(collapsed_path, "w", encoding="utf8") as f:
+            f.write(self._collapsed())
+
+        log.info("Writing profile summary to: %s", summary_path)
+        with open(summary_path, "w", encoding="utf8") as f:
+            f.write(self._summary(top))
+
+
+profiler = Profiler()
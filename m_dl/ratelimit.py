@@ -0,0 +1,192 @@
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, TypeVar
+from urllib.parse import urlparse
+
+from .config import config
+from .log import log
+
+T = TypeVar("T")
+
+# HTTP statuses that mean the server wants us to slow down
+THROTTLE_STATUSES = {429, 503}
+
+
+class ThrottledError(Exception):
+    """Raised when a site reports that it is busy, without an HTTP error"""
+
+    def __init__(self, msg: str, retry_after: float | None = None) -> None:
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """A token bucket whose rate is halved when throttled, and slowly recovers on success"""
+
+    def __init__(self, rate: float, *, burst: float = 1.0) -> None:
+        self.max_rate = rate
+        self.min_rate = rate / 32
+        self.rate = rate
+        self.burst = burst
+
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        # no requests may be made until this time, e.g. because of Retry-After
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request can be made"""
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    delay = (1 - self._tokens) / self.rate
+
+            time.sleep(delay)
+
+    def throttled(self, retry_after: float | None = None):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0
+
+            if retry_after is None:
+                retry_after = 1 / self.rate
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+_limiters: dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def _host(url: str):
+    host = urlparse(url).hostname if "://" in url else url
+    host = (host or "").lower()
+    return host.removeprefix("www.")
+
+
+def get_limiter(url: str):
+    """Return the shared rate limiter for the host of the given URL"""
+
+    host = _host(url)
+
+    with _limiters_lock:
+        if host not in _limiters:
+            rates = config.get("rate_limits", {})
+            assert isinstance(rates, dict)
+            rate = rates.get(host, config.get("rate_limit", 1.0))
+            _limiters[host] = RateLimiter(float(rate))
+
+        return _limiters[host]
+
+
+def _parse_retry_after(value: str | None):
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+def _causes(e: BaseException):
+    """Iterate through an exception and everything that caused it"""
+
+    seen = set()
+    stack = [e]
+
+    while len(stack) > 0:
+        e = stack.pop()
+        if e is None or id(e) in seen:
+            continue
+        seen.add(id(e))
+        yield e
+
+        # yt-dlp keeps the original exception in these attributes
+        cause = getattr(e, "cause", None)
+        if isinstance(cause, BaseException):
+            stack.append(cause)
+        exc_info = getattr(e, "exc_info", None)
+        if isinstance(exc_info, tuple) and len(exc_info) == 3:
+            stack.append(exc_info[1])
+
+        stack.append(e.__cause__)
+        stack.append(e.__context__)
+
+
+def throttle_delay(e: BaseException) -> tuple[bool, float | None]:
+    """Return whether the exception means we are being throttled, and how long the server asked us to wait"""
+
+    for cause in _causes(e):
+        if isinstance(cause, ThrottledError):
+            return True, cause.retry_after
+
+        # yt-dlp uses `status`, pyyoutube uses `status_code`
+        status = getattr(cause, "status", None) or getattr(cause, "status_code", None)
+        if status not in THROTTLE_STATUSES:
+            continue
+
+        response = getattr(cause, "response", None)
+        headers = getattr(response, "headers", None)
+        retry_after = headers.get("Retry-After") if headers is not None else None
+
+        return True, _parse_retry_after(retry_after)
+
+    return False, None
+
+
+def rate_limited(url: str, fn: Callable[[], T], *, retries: int = 3) -> T:
+    """Call `fn` once the host of `url` allows it, retrying if the host throttles us"""
+
+    limiter = get_limiter(url)
+
+    for attempt in range(retries + 1):
+        limiter.acquire()
+
+        try:
+            rv = fn()
+        except Exception as e:
+            throttled, retry_after = throttle_delay(e)
+            if not throttled:
+                raise
+
+            limiter.throttled(retry_after)
+            if attempt == retries:
+                raise
+
+            log.warning(
+                "Throttled by %s, slowing down to %.3f requests/s (%s)",
+                _host(url),
+                limiter.rate,
+                e,
+            )
+            continue
+
+        limiter.succeeded()
+        return rv
+
+    raise AssertionError("unreachable")
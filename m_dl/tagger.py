@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import TypedDict
+from typing import NotRequired, TypedDict
 
 from mediafile import MediaFile
 
@@ -10,6 +10,9 @@ class Tags(TypedDict):
     url: str
     added_at: datetime
 
+    rg_track_gain: NotRequired[float]
+    rg_track_peak: NotRequired[float]
+
 
 def tag_file(path, tags: Tags):
     mf = MediaFile(path)
@@ -26,4 +29,9 @@ def tag_file(path, tags: Tags):
     mf.url = tags["url"]
     mf.label = tags["url"]
 
+    if "rg_track_gain" in tags:
+        mf.rg_track_gain = tags["rg_track_gain"]
+    if "rg_track_peak" in tags:
+        mf.rg_track_peak = tags["rg_track_peak"]
+
     mf.save()
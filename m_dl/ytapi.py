@@ -1,10 +1,19 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
 from dataclasses import dataclass
 from datetime import datetime
+from pathlib import Path
 from typing import Literal
 
 import pyyoutube
 
 from .log import log
+from .ratelimit import rate_limited
+
+API_URL = "https://www.googleapis.com/youtube/v3"
 
 
 class VideoInaccessibleError(Exception):
@@ -83,6 +92,12 @@ class PlaylistItem:
         return self.channel
 
 
+def _hash_token(token: str | None):
+    if token is None:
+        return None
+    return hashlib.sha256(token.encode("utf8")).hexdigest()
+
+
 class YTApi:
     def __init__(
         self,
@@ -90,6 +105,7 @@ class YTApi:
         client_id: str | None = None,
         client_secret: str | None = None,
         refresh_token: str | None = None,
+        token_cache_path: str | Path | None = None,
     ) -> None:
         if client_id is None or client_secret is None:
             raise ValueError("Both client ID and client secret must be provided")
@@ -97,9 +113,106 @@ class YTApi:
         self._client_id = client_id
         self._client_secret = client_secret
         self._access_token: str | None = None
+        # unix timestamp in seconds
+        self._access_token_expires_at: float = 0
         self._refresh_token: str | None = refresh_token
+        # identifies the account the cached tokens belong to
+        self._config_token_hash = _hash_token(refresh_token)
+        self._token_cache_path = (
+            Path(token_cache_path) if token_cache_path is not None else None
+        )
+
+        # sessions are only created when the API is first used
+        self._load_token_cache()
+
+    def _load_token_cache(self):
+        """Restore tokens saved by a previous run, if they were created from the same client and refresh token"""
+
+        if self._token_cache_path is None or not self._token_cache_path.exists():
+            return
+
+        try:
+            with open(self._token_cache_path, "r", encoding="utf8") as f:
+                cache = json.load(f)
+            assert isinstance(cache, dict)
+        except Exception as e:
+            log.warning("Failed to read token cache, ignoring it", exc_info=e)
+            return
+
+        if cache.get("client_id") != self._client_id:
+            log.debug("Token cache belongs to a different client, ignoring it")
+            return
+
+        # the config may be for another account, or have a new refresh token after the old one was revoked
+        if cache.get("config_token_hash") != self._config_token_hash:
+            log.debug("Token cache belongs to a different refresh token, ignoring it")
+            return
+
+        log.debug("Loaded YouTube tokens from %s", self._token_cache_path)
+
+        self._access_token = cache.get("access_token")
+        self._access_token_expires_at = cache.get("expires_at", 0)
+        # refresh tokens may have been rotated since the config was written
+        if cache.get("refresh_token") is not None:
+            self._refresh_token = cache["refresh_token"]
+
+    def _save_token_cache(self):
+        if self._token_cache_path is None:
+            return
+
+        cache = {
+            "client_id": self._client_id,
+            "config_token_hash": self._config_token_hash,
+            "access_token": self._access_token,
+            "expires_at": self._access_token_expires_at,
+            "refresh_token": self._refresh_token,
+        }
+
+        self._token_cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # a unique name so concurrent runs don't write to the same file, mkstemp also makes it readable by the
+        # current user only
+        fd, temp_path = tempfile.mkstemp(
+            dir=self._token_cache_path.parent,
+            prefix=self._token_cache_path.name,
+            suffix=".tmp",
+        )
+        try:
+            with open(fd, "w", encoding="utf8") as f:
+                json.dump(cache, f)
+            os.replace(temp_path, self._token_cache_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _store_tokens(self, token: pyyoutube.AccessToken):
+        """Validate and store the tokens returned from the OAuth endpoint"""
+
+        access_token = token.access_token
+        assert isinstance(access_token, str) and len(access_token) > 0
+        self._access_token = access_token
+
+        # the refresh token may be rotated when refreshing
+        refresh_token = token.refresh_token
+        if isinstance(refresh_token, str) and len(refresh_token) > 0:
+            self._refresh_token = refresh_token
 
-        if refresh_token is None:
+        expires_in = token.expires_in if token.expires_in is not None else 3600
+        self._access_token_expires_at = time.time() + expires_in
+
+        self._save_token_cache()
+
+    def _ensure_session(self):
+        """Make sure there is an access token that isn't about to expire"""
+
+        # leave a margin so the token doesn't expire in the middle of a request
+        if (
+            self._access_token is not None
+            and time.time() < self._access_token_expires_at - 60
+        ):
+            return
+
+        if self._refresh_token is None:
             self._new_session()
         else:
             self._refresh_session()
@@ -129,16 +242,14 @@ class YTApi:
 
                 # validate access token
                 assert not isinstance(access_token, dict)
-                access_token = access_token.access_token
-                assert isinstance(access_token, str) and len(access_token) > 0
 
                 # validate refresh token
-                refresh_token = client.refresh_token
+                refresh_token = access_token.refresh_token or client.refresh_token
                 assert isinstance(refresh_token, str) and len(refresh_token) > 0
+                self._refresh_token = refresh_token
 
                 # store tokens
-                self._access_token = access_token
-                self._refresh_token = refresh_token
+                self._store_tokens(access_token)
 
                 break
 
@@ -168,31 +279,49 @@ class YTApi:
 
         # validate access token
         assert not isinstance(access_token, dict)
-        access_token = access_token.access_token
-        assert isinstance(access_token, str) and len(access_token) > 0
 
         # store access token
-        self._access_token = access_token
-
-    def iter_playlist_items(self, playlist_id: str):
-        """Iterate through all videos in the given playlist. This automatically handles pagination."""
+        self._store_tokens(access_token)
 
-        log.debug("Fetching items from playlist %s", playlist_id)
-
-        client = pyyoutube.Client(
+    def _client(self):
+        return pyyoutube.Client(
             client_id=self._client_id,
             client_secret=self._client_secret,
             access_token=self._access_token,
             refresh_token=self._refresh_token,
         )
 
+    def _call(self, request):
+        """Run an API request, refreshing the session once if the access token was rejected"""
+
+        self._ensure_session()
+
+        try:
+            return rate_limited(API_URL, lambda: request(self._client()))
+        except pyyoutube.PyYouTubeException as e:
+            if e.status_code != 401:
+                raise
+
+        log.info("Access token was rejected, refreshing session")
+        self._access_token = None
+        self._ensure_session()
+
+        return rate_limited(API_URL, lambda: request(self._client()))
+
+    def iter_playlist_items(self, playlist_id: str):
+        """Iterate through all videos in the given playlist. This automatically handles pagination."""
+
+        log.debug("Fetching items from playlist %s", playlist_id)
+
         next_page_token = None
 
         while True:
-            res = client.playlistItems.list(
-                playlist_id=playlist_id,
-                max_results=50,  # max value is 50
-                page_token=next_page_token,
+            res = self._call(
+                lambda client: client.playlistItems.list(
+                    playlist_id=playlist_id,
+                    max_results=50,  # max value is 50
+                    page_token=next_page_token,
+                )
             )
             assert not isinstance(res, dict)
             assert res.items is not None
@@ -4,6 +4,8 @@ from datetime import datetime
 import pytz
 from yt_dlp import YoutubeDL
 
+from .ratelimit import rate_limited
+
 
 @dataclass
 class YTDLPItem:
@@ -17,8 +19,11 @@ class YTDLPItem:
 
     @classmethod
     def from_url(cls, url: str):
-        with YoutubeDL() as ydl:
-            info = ydl.extract_info(url, download=False)
+        def extract():
+            with YoutubeDL() as ydl:
+                return ydl.extract_info(url, download=False)
+
+        info = rate_limited(url, extract)
         assert isinstance(info, dict)
 
         title = info["title"]
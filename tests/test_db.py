@@ -0,0 +1,214 @@
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+from sqlite3 import Connection
+
+from m_dl.db import Database
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tempdir.name) / "m-dl.db"
+
+        # the legacy table is expected to exist already
+        con = Connection(self.path)
+        con.execute(
+            "CREATE TABLE music (id INTEGER PRIMARY KEY, title TEXT, artist TEXT, url TEXT)"
+        )
+        con.commit()
+        con.close()
+
+        self.db = self.open()
+
+    def tearDown(self):
+        self.db.close()
+        self.tempdir.cleanup()
+
+    def open(self):
+        db = Database(self.path)
+        self.addCleanup(db.close)
+        return db
+
+    def add(self, db: Database, url: str, *, title="title", artist="artist", day=0):
+        db.add_url(
+            url,
+            title=title,
+            artist=artist,
+            added_at=datetime(2024, 1, 1) + timedelta(days=day),
+            processed=False,
+        )
+
+
+class TestMigrate(DatabaseTestCase):
+    def test_reopen(self):
+        self.add(self.db, "u0")
+        self.db.close()
+
+        db = self.open()
+        self.assertTrue(db.has_url("u0"))
+
+    def test_concurrent_migrate(self):
+        self.db.close()
+        self.path.unlink()
+        con = Connection(self.path)
+        con.execute(
+            "CREATE TABLE music (id INTEGER PRIMARY KEY, title TEXT, artist TEXT, url TEXT)"
+        )
+        con.commit()
+        con.close()
+
+        errors = []
+
+        def migrate():
+            try:
+                Database(self.path).close()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=migrate) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+
+
+class TestQueue(DatabaseTestCase):
+    def test_unprocessed_items_pages(self):
+        for i in range(7):
+            self.add(self.db, f"u{i}", day=i % 3)
+        self.db.mark_processed("u4", True)
+
+        urls = [item.url for item in self.db.unprocessed_items(page_size=2)]
+
+        self.assertEqual(urls, ["u0", "u3", "u6", "u1", "u2", "u5"])
+
+    def test_add_new_url(self):
+        self.assertTrue(
+            self.db.add_new_url(
+                "u0", title="t", artist="a", added_at=datetime(2024, 1, 1)
+            )
+        )
+        self.assertFalse(
+            self.db.add_new_url(
+                "u0", title="t", artist="a", added_at=datetime(2024, 1, 1)
+            )
+        )
+
+        count = self.db.con.execute("SELECT COUNT(*) FROM music_v2").fetchone()[0]
+        self.assertEqual(count, 1)
+
+    def test_owners_never_share_rows(self):
+        for i in range(10):
+            self.add(self.db, f"u{i}", day=i)
+
+        other = self.open()
+        first = self.db.claim_items("w1")
+        second = other.claim_items("w2")
+
+        claimed = {"w1": [], "w2": []}
+        done = False
+        while not done:
+            done = True
+            for owner, items in (("w1", first), ("w2", second)):
+                item = next(items, None)
+                if item is not None:
+                    claimed[owner].append(item.url)
+                    done = False
+
+        self.assertEqual(set(claimed["w1"]) & set(claimed["w2"]), set())
+        self.assertEqual(
+            sorted(claimed["w1"] + claimed["w2"]), sorted(f"u{i}" for i in range(10))
+        )
+
+    def test_owners_never_share_rows_concurrently(self):
+        for i in range(50):
+            self.add(self.db, f"u{i}", day=i)
+
+        claimed: dict[str, list[str]] = {}
+
+        def work(owner: str):
+            db = Database(self.path)
+            claimed[owner] = [item.url for item in db.claim_items(owner)]
+            db.close()
+
+        threads = [threading.Thread(target=work, args=(f"w{i}",)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        urls = [url for urls in claimed.values() for url in urls]
+        self.assertEqual(sorted(urls), sorted(f"u{i}" for i in range(50)))
+
+    def test_leased_rows_are_skipped(self):
+        self.add(self.db, "u0")
+
+        self.assertEqual([item.url for item in self.db.claim_items("w1")], ["u0"])
+        self.assertEqual(list(self.db.claim_items("w2")), [])
+
+    def test_expired_lease_is_reclaimable(self):
+        self.add(self.db, "u0")
+        self.assertEqual([item.url for item in self.db.claim_items("w1")], ["u0"])
+
+        self.db.con.execute("UPDATE music_v2 SET lease_expires_at = 0")
+
+        self.assertEqual([item.url for item in self.db.claim_items("w2")], ["u0"])
+        owner = self.db.con.execute("SELECT lease_owner FROM music_v2").fetchone()[0]
+        self.assertEqual(owner, "w2")
+
+    def test_release_respects_owner(self):
+        self.add(self.db, "u0")
+        self.assertEqual([item.url for item in self.db.claim_items("w1")], ["u0"])
+
+        self.db.release_item("u0", "w2")
+        self.assertEqual(list(self.db.claim_items("w2")), [])
+
+        self.db.release_item("u0", "w1")
+        self.assertEqual([item.url for item in self.db.claim_items("w2")], ["u0"])
+
+    def test_release_all(self):
+        for i in range(3):
+            self.add(self.db, f"u{i}", day=i)
+
+        first = self.db.claim_items("w1")
+        self.assertEqual(next(first).url, "u0")
+        self.assertEqual(next(first).url, "u1")
+        self.db.mark_processed("u0", True)
+        self.assertEqual([item.url for item in self.db.claim_items("w2")], ["u2"])
+
+        self.assertEqual(self.db.release_all("w1"), 1)
+
+        self.assertEqual(self.db.count_leased(exclude_owner="w2"), 0)
+        self.assertEqual(self.db.count_leased(exclude_owner="w3"), 1)
+        self.assertEqual([item.url for item in self.db.claim_items("w1")], ["u1"])
+
+    def test_count_leased_ignores_expired(self):
+        self.add(self.db, "u0")
+        self.assertEqual(len(list(self.db.claim_items("w1"))), 1)
+        self.assertEqual(self.db.count_leased(), 1)
+
+        self.db.con.execute("UPDATE music_v2 SET lease_expires_at = 0")
+
+        self.assertEqual(self.db.count_leased(), 0)
+
+    def test_processed_items_are_not_claimed(self):
+        self.add(self.db, "u0")
+        self.add(self.db, "u1")
+
+        for item in self.db.claim_items("w1"):
+            self.db.mark_processed(item.url, True)
+
+        self.assertEqual(list(self.db.claim_items("w2")), [])
+        leases = self.db.con.execute(
+            "SELECT lease_owner, lease_expires_at FROM music_v2"
+        ).fetchall()
+        self.assertEqual(leases, [(None, None), (None, None)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from m_dl.download import move_to_library
+
+
+class TestMoveToLibrary(unittest.TestCase):
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        root = Path(tempdir.name)
+
+        self.staging = root / "staging"
+        self.staging.mkdir()
+        self.library = root / "library"
+        self.library.mkdir()
+
+        self.staged = self.staging / "song.opus"
+        self.staged.write_bytes(b"new")
+
+    def cross_device(self):
+        return mock.patch("m_dl.download._same_device", return_value=False)
+
+    def test_same_device(self):
+        with mock.patch("shutil.copyfileobj") as copy:
+            output_path = move_to_library(self.staged, self.library)
+
+        copy.assert_not_called()
+        self.assertEqual(output_path, self.library / "song.opus")
+        self.assertEqual(output_path.read_bytes(), b"new")
+        self.assertFalse(self.staged.exists())
+
+    def test_cross_device(self):
+        with self.cross_device():
+            output_path = move_to_library(self.staged, self.library)
+
+        self.assertEqual(output_path.read_bytes(), b"new")
+        self.assertFalse(self.staged.exists())
+        self.assertEqual(list(self.library.iterdir()), [output_path])
+
+    def test_duplicate(self):
+        existing = self.library / "song.opus"
+        existing.write_bytes(b"old")
+
+        output_path = move_to_library(self.staged, self.library)
+
+        self.assertEqual(output_path, existing)
+        self.assertEqual(existing.read_bytes(), b"old")
+        self.assertFalse(self.staged.exists())
+
+    def test_failed_copy(self):
+        def copy(src, dst, length):
+            dst.write(b"ne")
+            raise OSError("disk full")
+
+        with self.cross_device(), mock.patch("shutil.copyfileobj", copy):
+            with self.assertRaises(OSError):
+                move_to_library(self.staged, self.library)
+
+        # the library is left untouched, and the staged file can be retried
+        self.assertEqual(list(self.library.iterdir()), [])
+        self.assertEqual(self.staged.read_bytes(), b"new")
+
+    def test_interrupted_copy(self):
+        with (
+            self.cross_device(),
+            mock.patch("shutil.copyfileobj", side_effect=KeyboardInterrupt),
+        ):
+            with self.assertRaises(KeyboardInterrupt):
+                move_to_library(self.staged, self.library)
+
+        self.assertEqual(list(self.library.iterdir()), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import tempfile
+import unittest
+from concurrent.futures import Future
+from datetime import datetime
+from pathlib import Path
+from sqlite3 import Connection
+from unittest import mock
+
+from m_dl import Ingest
+from m_dl.config import config
+from m_dl.db import Database
+
+
+class IngestTestCase(unittest.TestCase):
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.root = Path(tempdir.name)
+
+        self.library = self.root / "library"
+        self.library.mkdir()
+
+        db_path = self.root / "m-dl.db"
+        con = Connection(db_path)
+        con.execute(
+            "CREATE TABLE music (id INTEGER PRIMARY KEY, title TEXT, artist TEXT, url TEXT)"
+        )
+        con.commit()
+        con.close()
+
+        self.db = Database(db_path)
+        self.addCleanup(self.db.close)
+
+        saved_config = dict(config)
+        self.addCleanup(lambda: (config.clear(), config.update(saved_config)))
+        config.clear()
+        config["path"] = str(self.library)
+
+        self.tag_file = mock.patch("m_dl.tag_file").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def claim(self, url: str):
+        self.db.add_url(
+            url, title="title", artist="artist", added_at=datetime(2024, 1, 1)
+        )
+        return next(self.db.claim_items("w1"))
+
+    def state(self, url: str):
+        return self.db.con.execute(
+            "SELECT processed, lease_owner FROM music_v2 WHERE url = ?", (url,)
+        ).fetchone()
+
+
+class TestAnalysis(IngestTestCase):
+    def test_interrupted_worker(self):
+        item = self.claim("u0")
+        path = self.library / "song.opus"
+
+        ingest = Ingest(self.db, "w1")
+        future = Future()
+        future.set_exception(KeyboardInterrupt())
+        ingest.analyzing.append((item, path, future))
+
+        ingest.close()
+
+        # tagged without ReplayGain values
+        self.tag_file.assert_called_once()
+        self.assertNotIn("rg_track_gain", self.tag_file.call_args.args[1])
+        self.assertEqual(self.state("u0"), (1, None))
+
+
+class TestStaging(IngestTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.staging = self.root / "staging"
+        config["staging_path"] = str(self.staging)
+
+        def download(url, folder_path):
+            path = Path(folder_path) / "song.opus"
+            path.write_bytes(b"new")
+            return path
+
+        mock.patch("m_dl.download_and_get_path", download).start()
+
+        self.ingest = Ingest(self.db, "w1")
+        self.addCleanup(self.ingest.close)
+
+    def test_moved_to_library(self):
+        self.ingest.process(self.claim("u0"))
+        self.ingest.close()
+
+        self.assertEqual(self.tag_file.call_args.args[0], self.staging / "song.opus")
+        self.assertEqual((self.library / "song.opus").read_bytes(), b"new")
+        self.assertEqual(list(self.staging.iterdir()), [])
+        self.assertEqual(self.state("u0"), (1, None))
+
+    def test_duplicate_tags_library_file(self):
+        existing = self.library / "song.opus"
+        existing.write_bytes(b"old")
+
+        with mock.patch("m_dl.move_to_library") as move:
+            self.ingest.process(self.claim("u0"))
+            self.ingest.close()
+
+        move.assert_not_called()
+        self.assertEqual(self.tag_file.call_args.args[0], existing)
+        self.assertEqual(existing.read_bytes(), b"old")
+        self.assertEqual(list(self.staging.iterdir()), [])
+        self.assertEqual(self.state("u0"), (1, None))
+
+    def test_failed_tag_discards_staged_file(self):
+        self.tag_file.side_effect = ValueError("bad file")
+
+        with self.assertRaises(ValueError):
+            self.ingest.process(self.claim("u0"))
+
+        self.assertEqual(list(self.staging.iterdir()), [])
+        self.assertEqual(list(self.library.iterdir()), [])
+
+    def test_failed_move_discards_staged_file(self):
+        with mock.patch("m_dl.move_to_library", side_effect=OSError("disk full")):
+            self.ingest.process(self.claim("u0"))
+            self.ingest.close()
+
+        self.assertEqual(list(self.staging.iterdir()), [])
+        self.assertEqual(self.state("u0"), (0, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
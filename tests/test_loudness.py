@@ -0,0 +1,125 @@
+import unittest
+
+try:
+    import numpy as np
+except ImportError:
+    raise unittest.SkipTest("numpy is not installed")
+
+from m_dl.loudness import (
+    FRAME_SIZE,
+    K_WEIGHTING,
+    OVERLAP,
+    SAMPLE_RATE,
+    _gated_loudness,
+    _loudness,
+    _measure,
+)
+
+
+def sine(seconds: float, *, frequency=997.0, amplitude=1.0, channels=1):
+    t = np.arange(int(SAMPLE_RATE * seconds)) / SAMPLE_RATE
+    wave = amplitude * np.sin(2 * np.pi * frequency * t)
+    return np.tile(wave, (channels, 1)).astype(np.float32)
+
+
+def noise(seconds: float, channels=2):
+    """Noise that gets louder over time, so that the gates have something to do"""
+
+    n = int(SAMPLE_RATE * seconds)
+    rng = np.random.default_rng(0)
+    return (rng.standard_normal((channels, n)) * 0.1 * np.linspace(0, 1, n)).astype(
+        np.float32
+    )
+
+
+def split(samples, sizes: list[int]):
+    """Split samples into chunks of the given sizes, followed by the rest"""
+
+    chunks = []
+    start = 0
+    for size in sizes:
+        chunks.append(samples[:, start : start + size])
+        start += size
+    chunks.append(samples[:, start:])
+    return chunks
+
+
+def integrated(chunks):
+    return _gated_loudness(_measure(chunks)[0])
+
+
+class TestLoudness(unittest.TestCase):
+    def test_full_scale_sine(self):
+        # BS.1770 calibration: a 0 dBFS sine around 1 kHz in one channel reads -3.01 LUFS
+        self.assertAlmostEqual(integrated([sine(20)]), -3.01, delta=0.01)
+        self.assertAlmostEqual(
+            integrated([sine(20, frequency=1000.0)]), -3.01, delta=0.01
+        )
+
+    def test_channels_are_summed(self):
+        self.assertAlmostEqual(integrated([sine(20, channels=2)]), 0.0, delta=0.01)
+
+    def test_replaygain(self):
+        loudness = _loudness([sine(20, amplitude=0.5, channels=2)])
+
+        self.assertAlmostEqual(loudness.integrated, -6.02, delta=0.01)
+        self.assertAlmostEqual(loudness.track_gain, -11.98, delta=0.01)
+        self.assertAlmostEqual(loudness.track_peak, 0.5, delta=1e-6)
+
+    def test_silence(self):
+        loudness = _loudness([np.zeros((2, SAMPLE_RATE * 5), dtype=np.float32)])
+
+        self.assertEqual(loudness.integrated, float("-inf"))
+        self.assertEqual(loudness.track_gain, 0.0)
+        self.assertEqual(loudness.track_peak, 0.0)
+
+    def test_too_short(self):
+        self.assertEqual(integrated([sine(0.3)]), float("-inf"))
+        self.assertEqual(integrated([]), float("-inf"))
+
+    def test_unaligned_chunks(self):
+        samples = noise(30)
+        expected = integrated([samples])
+
+        for sizes in (
+            [1, 4799, 100003],
+            [FRAME_SIZE - OVERLAP] * 5,
+            [FRAME_SIZE + 1, 7, SAMPLE_RATE * 3 + 11],
+            [SAMPLE_RATE // 7] * 200,
+        ):
+            with self.subTest(sizes=sizes[:3]):
+                self.assertAlmostEqual(
+                    integrated(split(samples, sizes)), expected, delta=1e-4
+                )
+
+    def test_matches_iir_filter(self):
+        try:
+            from scipy.signal import lfilter
+        except ImportError:
+            self.skipTest("scipy is not installed")
+
+        samples = noise(60)
+
+        weighted = samples.astype(np.float64)
+        for b0, b1, b2, a1, a2 in K_WEIGHTING:
+            weighted = lfilter([b0, b1, b2], [1, a1, a2], weighted, axis=1)
+
+        # straightforward BS.1770 gating over 400 ms blocks
+        block = SAMPLE_RATE * 4 // 10
+        step = SAMPLE_RATE // 10
+        power = np.array(
+            [
+                np.mean(weighted[:, i : i + block] ** 2, axis=1).sum()
+                for i in range(0, weighted.shape[1] - block + 1, step)
+            ]
+        )
+        power = power[-0.691 + 10 * np.log10(power) > -70]
+        gate = -0.691 + 10 * np.log10(power.mean()) - 10
+        power = power[-0.691 + 10 * np.log10(power) > gate]
+        expected = -0.691 + 10 * np.log10(power.mean())
+
+        self.assertAlmostEqual(integrated([samples]), expected, delta=1e-5)
+
+
+if __name__ == "__main__":
+    unittest.main()
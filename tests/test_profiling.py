@@ -0,0 +1,92 @@
+import pstats
+import time
+import unittest
+
+from m_dl.profiling import Profiler
+
+
+def spin(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def leaf():
+    spin(0.02)
+
+
+def branch():
+    leaf()
+    spin(0.01)
+
+
+def work():
+    branch()
+    leaf()
+
+
+def parse(collapsed: str):
+    lines = {}
+    for line in collapsed.splitlines():
+        key, count = line.rsplit(" ", 1)
+        lines[key] = int(count)
+    return lines
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.profiler = Profiler()
+        self.profiler.enable()
+
+    def test_disabled(self):
+        profiler = Profiler()
+        with profiler.stage("download", "u0"):
+            work()
+
+        self.assertEqual(profiler.profiles, [])
+
+    def test_nested_stages(self):
+        with self.profiler.stage("download", "u0"):
+            with self.profiler.stage("tag", "u0"):
+                work()
+
+        self.assertEqual([p.stage for p in self.profiler.profiles], ["download"])
+
+    def test_collapsed_stacks(self):
+        with self.profiler.stage("download", "https://example.com/a;b"):
+            work()
+
+        lines = parse(self.profiler._collapsed())
+
+        for key in lines:
+            self.assertTrue(key.startswith("download;https://example.com/a_b;"), key)
+
+        def frames(key: str):
+            return [frame.split(" ")[0] for frame in key.split(";")[2:]]
+
+        stacks = {tuple(frames(key)) for key in lines}
+        self.assertIn(("work", "branch", "leaf", "spin"), stacks)
+        self.assertIn(("work", "leaf", "spin"), stacks)
+
+        # time is attributed to the right branches
+        leaf_time = sum(count for key, count in lines.items() if "leaf" in frames(key))
+        self.assertAlmostEqual(leaf_time / 1_000_000, 0.04, delta=0.01)
+
+        # all of the stage's time ends up in some stack
+        stats = pstats.Stats(self.profiler.profiles[0].profile)
+        total = sum(lines.values()) / 1_000_000
+        self.assertAlmostEqual(total, stats.total_tt, delta=stats.total_tt * 0.05)
+
+    def test_stage_without_url(self):
+        with self.profiler.stage("fetch"):
+            work()
+
+        lines = parse(self.profiler._collapsed())
+
+        for key in lines:
+            self.assertTrue(key.startswith("fetch;"), key)
+        self.assertTrue(any(key.startswith("fetch;work ") for key in lines))
+
+
+if __name__ == "__main__":
+    unittest.main()
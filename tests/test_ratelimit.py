@@ -0,0 +1,186 @@
+import io
+import sys
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pyyoutube
+import requests
+from yt_dlp.networking import Response
+from yt_dlp.networking.exceptions import HTTPError
+from yt_dlp.utils import DownloadError, ExtractorError
+
+from m_dl import ratelimit
+from m_dl.download import NicoVideoBusyException
+from m_dl.ratelimit import (
+    RateLimiter,
+    _parse_retry_after,
+    rate_limited,
+    throttle_delay,
+)
+
+
+def ytdlp_error(status: int, headers: dict[str, str] | None = None):
+    """Build a DownloadError the way yt-dlp wraps an HTTP error during extraction"""
+
+    response = Response(
+        io.BytesIO(b""), "https://example.com", headers or {}, status=status
+    )
+    try:
+        try:
+            raise HTTPError(response)
+        except HTTPError as e:
+            raise ExtractorError("Unable to download webpage", cause=e)
+    except ExtractorError:
+        return DownloadError("ERROR: Unable to download webpage", sys.exc_info())
+
+
+def pyyoutube_error(status: int, headers: dict[str, str] | None = None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    response._content = (
+        b'{"error": {"code": %d, "message": "error", "errors": []}}' % status
+    )
+    return pyyoutube.PyYouTubeException(response)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_backoff(self):
+        limiter = RateLimiter(8.0)
+
+        limiter.throttled(0)
+        self.assertEqual(limiter.rate, 4.0)
+        limiter.throttled(0)
+        self.assertEqual(limiter.rate, 2.0)
+
+        for _ in range(10):
+            limiter.throttled(0)
+        self.assertEqual(limiter.rate, limiter.min_rate)
+
+    def test_recovery(self):
+        limiter = RateLimiter(10.0)
+        limiter.throttled(0)
+        limiter.throttled(0)
+
+        limiter.succeeded()
+        self.assertAlmostEqual(limiter.rate, 3.0)
+
+        for _ in range(100):
+            limiter.succeeded()
+        self.assertEqual(limiter.rate, limiter.max_rate)
+
+    def test_acquire_waits_for_retry_after(self):
+        limiter = RateLimiter(1000.0)
+        limiter.throttled(0.2)
+
+        start = time.monotonic()
+        limiter.acquire()
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+    def test_acquire_paces_requests(self):
+        limiter = RateLimiter(20.0)
+
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.acquire()
+
+        # the first request uses the initial token
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+
+class TestThrottleDelay(unittest.TestCase):
+    def test_ytdlp(self):
+        self.assertEqual(
+            throttle_delay(ytdlp_error(429, {"Retry-After": "5"})), (True, 5.0)
+        )
+        self.assertEqual(throttle_delay(ytdlp_error(503)), (True, None))
+        self.assertEqual(throttle_delay(ytdlp_error(404)), (False, None))
+
+    def test_pyyoutube(self):
+        self.assertEqual(
+            throttle_delay(pyyoutube_error(429, {"Retry-After": "7"})), (True, 7.0)
+        )
+        self.assertEqual(throttle_delay(pyyoutube_error(401)), (False, None))
+
+    def test_chained(self):
+        try:
+            try:
+                raise pyyoutube_error(429)
+            except pyyoutube.PyYouTubeException as e:
+                raise RuntimeError("request failed") from e
+        except RuntimeError as e:
+            self.assertEqual(throttle_delay(e), (True, None))
+
+    def test_nicovideo_busy(self):
+        self.assertEqual(throttle_delay(NicoVideoBusyException()), (True, None))
+
+    def test_other_errors(self):
+        self.assertEqual(throttle_delay(ValueError("nope")), (False, None))
+
+
+class TestParseRetryAfter(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(_parse_retry_after("120"), 120.0)
+        self.assertEqual(_parse_retry_after("-5"), 0.0)
+
+    def test_date(self):
+        date = datetime.now(timezone.utc) + timedelta(seconds=60)
+        delay = _parse_retry_after(format_datetime(date, usegmt=True))
+
+        assert delay is not None
+        self.assertAlmostEqual(delay, 60, delta=2)
+
+    def test_past_date(self):
+        self.assertEqual(_parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+
+    def test_invalid(self):
+        self.assertIsNone(_parse_retry_after(None))
+        self.assertIsNone(_parse_retry_after("soon"))
+
+
+class TestRateLimited(unittest.TestCase):
+    def setUp(self):
+        self.url = "https://ratelimit.test/video"
+        ratelimit._limiters["ratelimit.test"] = RateLimiter(1000.0)
+        self.addCleanup(ratelimit._limiters.pop, "ratelimit.test")
+
+    def test_retries_when_throttled(self):
+        calls = []
+
+        def fn():
+            calls.append(None)
+            if len(calls) < 3:
+                raise ytdlp_error(429, {"Retry-After": "0"})
+            return "done"
+
+        self.assertEqual(rate_limited(self.url, fn), "done")
+        self.assertEqual(len(calls), 3)
+
+    def test_gives_up_after_retries(self):
+        calls = []
+
+        def fn():
+            calls.append(None)
+            raise ytdlp_error(429, {"Retry-After": "0"})
+
+        with self.assertRaises(DownloadError):
+            rate_limited(self.url, fn, retries=2)
+        self.assertEqual(len(calls), 3)
+
+    def test_other_errors_are_not_retried(self):
+        calls = []
+
+        def fn():
+            calls.append(None)
+            raise ValueError("nope")
+
+        with self.assertRaises(ValueError):
+            rate_limited(self.url, fn)
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+from tests.test_db import DatabaseTestCase
+
+
+class TestSearch(DatabaseTestCase):
+    def search(self, query: str):
+        return [r.url for r in self.db.search(query)]
+
+    def test_insert(self):
+        self.add(self.db, "u0", title="Hello World", artist="Someone")
+
+        self.assertEqual(self.search("hel"), ["u0"])
+        self.assertEqual(self.search("someone world"), ["u0"])
+        self.assertEqual(self.search("nothing"), [])
+
+    def test_update(self):
+        self.add(self.db, "u0", title="Hello World")
+
+        self.db.con.execute("UPDATE music_v2 SET title = 'Goodbye' WHERE url = 'u0'")
+
+        self.assertEqual(self.search("hello"), [])
+        self.assertEqual(self.search("goodbye"), ["u0"])
+
+    def test_update_unindexed_column(self):
+        self.add(self.db, "u0", title="Hello World")
+
+        self.db.mark_processed("u0", True)
+
+        results = list(self.db.search("hello"))
+        self.assertEqual([r.url for r in results], ["u0"])
+        self.assertTrue(results[0].processed)
+
+    def test_delete(self):
+        self.add(self.db, "u0", title="Hello World")
+
+        self.db.con.execute("DELETE FROM music_v2 WHERE url = 'u0'")
+
+        self.assertEqual(self.search("hello"), [])
+
+    def test_legacy_table(self):
+        execute = self.db.con.execute
+        execute(
+            "INSERT INTO music (title, artist, url) VALUES ('Old Song', 'Legacy', 'old')"
+        )
+        self.add(self.db, "new", title="Old Song")
+
+        results = {r.url: r for r in self.db.search("old song")}
+        self.assertEqual(set(results), {"old", "new"})
+        self.assertIsNone(results["old"].added_at)
+
+        execute("UPDATE music SET title = 'Renamed' WHERE url = 'old'")
+        self.assertEqual(self.search("renamed"), ["old"])
+
+        execute("DELETE FROM music WHERE url = 'old'")
+        self.assertEqual(self.search("renamed"), [])
+
+    def test_existing_rows_are_indexed(self):
+        self.add(self.db, "u0", title="Hello World")
+        self.db.con.execute("DROP TABLE music_search")
+        self.db.close()
+
+        self.db = self.open()
+
+        self.assertEqual(self.search("hello"), ["u0"])
+
+    def test_empty_query(self):
+        with self.assertRaises(ValueError):
+            self.search("   ")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import pyyoutube
+
+from m_dl import ratelimit
+from m_dl.ratelimit import RateLimiter
+from m_dl.ytapi import YTApi
+from tests.test_ratelimit import pyyoutube_error
+
+
+class YTApiTestCase(unittest.TestCase):
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.cache_path = Path(tempdir.name) / "token.json"
+
+        self.refresh = mock.patch.object(
+            pyyoutube.Client, "refresh_access_token", side_effect=self.new_token
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+
+        ratelimit._limiters["www.googleapis.com"] = RateLimiter(1000.0)
+        self.addCleanup(ratelimit._limiters.pop, "www.googleapis.com")
+
+    def new_token(self, refresh_token: str):
+        return pyyoutube.AccessToken(
+            access_token=f"access-{self.refresh.call_count}",
+            expires_in=3600,
+            refresh_token=f"rotated-{self.refresh.call_count}",
+        )
+
+    def api(self, refresh_token="config-token", client_id="client"):
+        return YTApi(
+            client_id=client_id,
+            client_secret="secret",
+            refresh_token=refresh_token,
+            token_cache_path=self.cache_path,
+        )
+
+    def read_cache(self):
+        with open(self.cache_path, "r", encoding="utf8") as f:
+            return json.load(f)
+
+
+class TestTokenCache(YTApiTestCase):
+    def test_reused_between_runs(self):
+        self.api()._ensure_session()
+        self.assertEqual(self.refresh.call_count, 1)
+
+        api = self.api()
+        api._ensure_session()
+
+        self.assertEqual(self.refresh.call_count, 1)
+        self.assertEqual(api._access_token, "access-1")
+
+    @unittest.skipIf(os.name == "nt", "file modes are not supported on Windows")
+    def test_private(self):
+        self.api()._ensure_session()
+
+        self.assertEqual(os.stat(self.cache_path).st_mode & 0o777, 0o600)
+        self.assertEqual(os.listdir(self.cache_path.parent), ["token.json"])
+
+    def test_rotated_refresh_token(self):
+        self.api()._ensure_session()
+        self.assertEqual(self.read_cache()["refresh_token"], "rotated-1")
+
+        api = self.api()
+        self.assertEqual(api._refresh_token, "rotated-1")
+
+        # the cache still belongs to the refresh token from the config
+        api._access_token = None
+        api._ensure_session()
+        self.assertEqual(self.refresh.call_args.args[0], "rotated-1")
+        self.assertEqual(self.api()._access_token, "access-2")
+
+    def test_different_refresh_token(self):
+        self.api()._ensure_session()
+
+        api = self.api(refresh_token="other-token")
+
+        self.assertIsNone(api._access_token)
+        self.assertEqual(api._refresh_token, "other-token")
+
+    def test_different_client(self):
+        self.api()._ensure_session()
+
+        api = self.api(client_id="other-client")
+
+        self.assertIsNone(api._access_token)
+        self.assertEqual(api._refresh_token, "config-token")
+
+    def test_corrupt_cache(self):
+        self.cache_path.write_text("{", encoding="utf8")
+
+        api = self.api()
+
+        self.assertIsNone(api._access_token)
+        self.assertEqual(api._refresh_token, "config-token")
+
+    def test_expiry_margin(self):
+        api = self.api()
+        api._access_token = "access-0"
+
+        api._access_token_expires_at = time.time() + 120
+        api._ensure_session()
+        self.assertEqual(self.refresh.call_count, 0)
+
+        api._access_token_expires_at = time.time() + 30
+        api._ensure_session()
+        self.assertEqual(self.refresh.call_count, 1)
+        self.assertEqual(api._access_token, "access-1")
+
+
+class TestCall(YTApiTestCase):
+    def test_retries_once_after_401(self):
+        api = self.api()
+        api._ensure_session()
+
+        tokens = []
+
+        def request(client: pyyoutube.Client):
+            tokens.append(client.access_token)
+            if len(tokens) == 1:
+                raise pyyoutube_error(401)
+            return "done"
+
+        self.assertEqual(api._call(request), "done")
+        self.assertEqual(tokens, ["access-1", "access-2"])
+
+    def test_gives_up_after_second_401(self):
+        api = self.api()
+        calls = []
+
+        def request(client: pyyoutube.Client):
+            calls.append(None)
+            raise pyyoutube_error(401)
+
+        with self.assertRaises(pyyoutube.PyYouTubeException):
+            api._call(request)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.refresh.call_count, 2)
+
+    def test_other_errors_are_not_retried(self):
+        api = self.api()
+        calls = []
+
+        def request(client: pyyoutube.Client):
+            calls.append(None)
+            raise pyyoutube_error(404)
+
+        with self.assertRaises(pyyoutube.PyYouTubeException):
+            api._call(request)
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()